@@ -1,11 +1,41 @@
+import bisect
+import mmap
 import os
 import struct
+from array import array
+from collections import OrderedDict
 import sys
 import logging
 
 BLOCK_SIZE = 512
-MAGIC_HEADER = b'BTREEIDX'
-MIN_DEGREE = 4
+MAGIC_HEADER = b'BTREEID2'
+# Largest degree whose full node fits one block: 2-byte header, then
+# (2t-1) 4-byte keys and values plus 2t 4-byte child block numbers = 498 bytes at t=21
+MIN_DEGREE = 21
+MAX_UINT32 = 2**32 - 1
+NODE_CACHE_SIZE = 1024
+PREALLOC_BLOCKS = 256
+
+# Node layout: is_leaf, num_keys, keys, values, child block numbers
+NODE_HEADER = struct.Struct('>?B')
+_PACKERS = {}
+
+_ZERO_BLOCK = memoryview(bytes(BLOCK_SIZE))
+
+def get_packer(num_keys, num_children):
+    packer = _PACKERS.get((num_keys, num_children))
+    if packer is None:
+        packer = struct.Struct('>?B' + 'I' * num_keys + 'I' * num_keys + 'I' * num_children)
+        _PACKERS[(num_keys, num_children)] = packer
+    return packer
+
+def read_array(typecode, data, pos, count):
+    # Node fields are stored big-endian; array works in native byte order
+    values = array(typecode)
+    values.frombytes(data[pos:pos + count * values.itemsize])
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values
 
 # Configure logging
 logging.basicConfig(level=logging.ERROR)
@@ -21,7 +51,15 @@ class DuplicateKeyError(Exception):
 class IndexManager:
     def __init__(self):
         self.index_file = None
+        self.fd = None
+        self.mm = None
+        self.file_end = 0
+        self.reserved_end = 0
+        self.node_cache = OrderedDict()
+        self.dirty_nodes = {}
         self.root = None
+        self.root_offset = 0
+        self.root_offset_dirty = False
 
     def create_index_file(self, filename):
         try:
@@ -30,11 +68,18 @@ class IndexManager:
                 if choice != 'y':
                     print("Operation cancelled.")
                     return
+            # Flush and release the current index first, in case it is the file being overwritten
+            self.close()
             with open(filename, 'wb') as f:
                 # Write file header: magic number + root offset + padding
                 f.write(MAGIC_HEADER)
                 f.write(struct.pack('>Q', 0))  # Root offset = 0 means empty tree
                 f.write(b'\x00' * (BLOCK_SIZE - len(MAGIC_HEADER) - 8))
+            self.fd = os.open(filename, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+            self.file_end = self.reserved_end = BLOCK_SIZE
+            self.map_file()
+            self.index_file = filename
+            self.root = None
             print(f"Index file '{filename}' created.")
         except IOError as e:
             logger.error(str(e))
@@ -45,13 +90,19 @@ class IndexManager:
             if not os.path.exists(filename):
                 print(f"Error: File '{filename}' does not exist.")
                 return
-            with open(filename, 'rb') as f:
-                magic = f.read(len(MAGIC_HEADER))
-                if magic != MAGIC_HEADER:
-                    raise IndexFileError("Invalid index file format.")
-                root_offset = struct.unpack('>Q', f.read(8))[0]
-                self.root = BTreeNode(self, offset=root_offset) if root_offset != 0 else None
+            fd = os.open(filename, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+            header = os.pread(fd, len(MAGIC_HEADER) + 8, 0)
+            if header[:len(MAGIC_HEADER)] != MAGIC_HEADER:
+                os.close(fd)
+                raise IndexFileError("Invalid index file format.")
+            root_offset = struct.unpack_from('>Q', header, len(MAGIC_HEADER))[0]
+            self.close()
+            self.fd = fd
+            self.file_end = self.reserved_end = os.fstat(fd).st_size
+            self.map_file()
             self.index_file = filename
+            self.root_offset = root_offset
+            self.root = self.get_node(root_offset) if root_offset != 0 else None
             print(f"Index file '{filename}' opened.")
         except IndexFileError as e:
             logger.error(str(e))
@@ -61,20 +112,82 @@ class IndexManager:
             print("Error opening index file.")
 
     def update_root_offset(self, offset):
+        # The header is rewritten on flush() rather than on every root split
+        if self.index_file is None:
+            return
+        self.root_offset = offset
+        self.root_offset_dirty = True
+
+    def flush(self):
+        # Called at command boundaries: writes back dirty nodes, then the root offset
         if self.index_file is None:
             return
+        self.flush_dirty()
+        if not self.root_offset_dirty:
+            return
         try:
-            with open(self.index_file, 'r+b') as f:
-                f.seek(len(MAGIC_HEADER))
-                f.write(struct.pack('>Q', offset))
+            os.pwrite(self.fd, struct.pack('>Q', self.root_offset), len(MAGIC_HEADER))
+            self.root_offset_dirty = False
         except IOError as e:
             logger.error(str(e))
             print("Error updating root offset.")
 
-    def insert(self, key, value):
+    def flush_dirty(self):
+        if self.dirty_nodes:
+            self.save_nodes(list(self.dirty_nodes.values()))
+
+    def map_file(self):
+        # Nodes are read straight from a shared mapping of the file. Writes still
+        # go through pwrite on the same file, which the mapping sees immediately.
+        if self.mm is not None:
+            self.mm.close()
+        self.mm = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self.fd is not None:
+            self.flush()
+            if self.mm is not None:
+                self.mm.close()
+            try:
+                # Drop the unused tail of the last preallocated chunk
+                os.ftruncate(self.fd, self.file_end)
+            except IOError as e:
+                logger.error(str(e))
+            os.close(self.fd)
+        self.fd = None
+        self.mm = None
+        self.index_file = None
+        self.node_cache.clear()
+        self.dirty_nodes.clear()
+        self.root = None
+        self.root_offset = 0
+        self.root_offset_dirty = False
+
+    def get_node(self, offset):
+        node = self.node_cache.get(offset)
+        if node is None:
+            node = BTreeNode(self, offset=offset)
+        else:
+            self.node_cache.move_to_end(offset)
+        return node
+
+    def cache_node(self, node):
+        # Least recently used nodes are dropped first; a dirty node is written
+        # back on eviction so it can always be reloaded from disk.
+        self.node_cache[node.offset] = node
+        self.node_cache.move_to_end(node.offset)
+        if len(self.node_cache) > NODE_CACHE_SIZE:
+            _, evicted = self.node_cache.popitem(last=False)
+            if evicted.dirty:
+                self.save_nodes([evicted])
+
+    def insert(self, key, value, verbose=True):
         if self.index_file is None:
             print("Error: No index file is open.")
-            return
+            return False
+        if not (0 <= key <= MAX_UINT32 and 0 <= value <= MAX_UINT32):
+            print(f"Error: Key and value must be between 0 and {MAX_UINT32}.")
+            return False
         try:
             # If the tree is empty, create a new root
             if self.root is None:
@@ -92,13 +205,16 @@ class IndexManager:
                     self.root = new_root
                     self.update_root_offset(self.root.offset)
                 self.root.insert_non_full(key, value)
-            print(f"Inserted key {key}.")
+            if verbose:
+                print(f"Inserted key {key}.")
+            return True
         except DuplicateKeyError as e:
             logger.error(str(e))
             print(e)
-        except Exception as e:
+        except IOError as e:
             logger.error(str(e))
             print("An error occurred during insertion.")
+        return False
 
     def search(self, key):
         if self.index_file is None:
@@ -106,7 +222,7 @@ class IndexManager:
             return
         try:
             if self.root:
-                value = self.root.search_key(key)
+                value = self.search_key(key)
                 if value is not None:
                     print(f"Found key {key} with value {value}.")
                 else:
@@ -117,6 +233,17 @@ class IndexManager:
             logger.error(str(e))
             print("An error occurred during search.")
 
+    def search_key(self, key):
+        node = self.root
+        while node is not None:
+            i = bisect.bisect_left(node.keys, key)
+            if i < len(node.keys) and node.keys[i] == key:
+                return node.values[i]
+            if node.is_leaf:
+                return None
+            node = self.get_node(node.children[i])
+        return None
+
     def load_data(self, filename):
         if self.index_file is None:
             print("Error: No index file is open.")
@@ -125,34 +252,176 @@ class IndexManager:
             print(f"Error: File '{filename}' does not exist.")
             return
         try:
+            pairs = []
             with open(filename, 'r') as f:
-                for line in f:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    parts = line.split(',')
-                    if len(parts) != 2:
-                        print(f"Invalid line: {line}")
-                        continue
-                    try:
-                        key = int(parts[0].strip())
-                        value = int(parts[1].strip())
-                        self.insert(key, value)
-                    except ValueError:
-                        print(f"Invalid key/value: {line}")
-                        continue
-            print(f"Data loaded from '{filename}'.")
+                lines = f.read().splitlines()
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    continue
+                parts = line.split(',')
+                if len(parts) != 2:
+                    print(f"Invalid line: {line}")
+                    continue
+                try:
+                    key = int(parts[0].strip())
+                    value = int(parts[1].strip())
+                except ValueError:
+                    print(f"Invalid key/value: {line}")
+                    continue
+                if not (0 <= key <= MAX_UINT32 and 0 <= value <= MAX_UINT32):
+                    print(f"Invalid key/value: {line}")
+                    continue
+                pairs.append((key, value))
+            if self.root is None:
+                inserted = self.bulk_load(pairs)
+            else:
+                inserted = 0
+                for key, value in pairs:
+                    if self.insert(key, value, verbose=False):
+                        inserted += 1
+            self.flush()
+            print(f"Data loaded from '{filename}': {inserted} of {len(pairs)} entries inserted.")
         except IOError as e:
             logger.error(str(e))
             print("Error loading data from file.")
 
+    def bulk_load(self, pairs):
+        # Builds the tree bottom-up from sorted pairs; only valid on an empty tree
+        keys = array('I')
+        values = array('I')
+        for key, value in sorted(pairs, key=lambda pair: pair[0]):
+            if keys and keys[-1] == key:
+                print(f"Error: Duplicate key {key}.")
+                continue
+            keys.append(key)
+            values.append(value)
+        if not keys:
+            return 0
+        count = len(keys)
+        direct_fd = self.open_direct()
+        try:
+            children = None
+            while True:
+                level, keys, values = self.build_level(keys, values, children)
+                # Nodes of a level are allocated back to back, so this is a single write
+                if direct_fd is not None and not self.save_nodes_direct(direct_fd, level):
+                    # Later levels would be refused the same way
+                    os.close(direct_fd)
+                    direct_fd = None
+                if direct_fd is None:
+                    self.save_nodes(level)
+                if len(level) == 1:
+                    break
+                children = array('Q', [node.offset for node in level])
+        finally:
+            if direct_fd is not None:
+                os.close(direct_fd)
+        self.root = level[0]
+        self.update_root_offset(self.root.offset)
+        return count
+
+    def build_level(self, keys, values, children):
+        # Packs one level of nodes as evenly as possible (every node gets at least
+        # MIN_DEGREE - 1 keys) and returns them with the separators for the level above
+        num_nodes = -(-(len(keys) + 1) // (2 * MIN_DEGREE))
+        size, extra = divmod(len(keys) - (num_nodes - 1), num_nodes)
+        nodes = []
+        up_keys = array('I')
+        up_values = array('I')
+        pos = 0
+        for j in range(num_nodes):
+            end = pos + size + (1 if j < extra else 0)
+            node = BTreeNode(self, is_leaf=children is None)
+            node.keys = keys[pos:end]
+            node.values = values[pos:end]
+            if children is not None:
+                node.children = children[pos:end + 1]
+            nodes.append(node)
+            if end < len(keys):
+                up_keys.append(keys[end])
+                up_values.append(values[end])
+            pos = end + 1
+        return nodes, up_keys, up_values
+
+    def open_direct(self):
+        # Bulk loads write whole levels of new blocks that are not read back soon,
+        # so they bypass the page cache where the platform supports it
+        if not hasattr(os, 'O_DIRECT'):
+            return None
+        try:
+            return os.open(self.index_file, os.O_RDWR | os.O_DIRECT)
+        except OSError:
+            return None
+
+    def save_nodes_direct(self, fd, nodes):
+        # nodes must be adjacent blocks in offset order. O_DIRECT needs an aligned
+        # buffer, which an anonymous mapping always is. Returns False if the write is
+        # refused (e.g. the device needs larger alignment) so the caller can fall back.
+        buf = mmap.mmap(-1, len(nodes) * BLOCK_SIZE)
+        try:
+            for j, node in enumerate(nodes):
+                node.pack(buf, j * BLOCK_SIZE)
+            os.pwrite(fd, buf, nodes[0].offset)
+        except OSError as e:
+            logger.debug("O_DIRECT write refused, falling back to buffered writes: %s", e)
+            return False
+        finally:
+            buf.close()
+        for node in nodes:
+            node.dirty = False
+        return True
+
+    def save_nodes(self, nodes):
+        # Writes each run of adjacent blocks with one write call
+        try:
+            nodes = sorted(nodes, key=lambda node: node.offset)
+            start = 0
+            while start < len(nodes):
+                end = start + 1
+                while end < len(nodes) and nodes[end].offset == nodes[end - 1].offset + BLOCK_SIZE:
+                    end += 1
+                buf = bytearray((end - start) * BLOCK_SIZE)
+                for j in range(start, end):
+                    nodes[j].pack(buf, (j - start) * BLOCK_SIZE)
+                os.pwrite(self.fd, buf, nodes[start].offset)
+                start = end
+            for node in nodes:
+                node.dirty = False
+                self.dirty_nodes.pop(node.offset, None)
+        except IOError as e:
+            logger.error(str(e))
+            print("Error saving node.")
+
+    def traverse(self, output_file=None):
+        # In-order traversal with an explicit stack of (node, next child index);
+        # entries are written in batches rather than one call per line
+        write = (output_file or sys.stdout).write
+        batch = []
+        stack = [(self.root, 0)]
+        while stack:
+            node, i = stack.pop()
+            if node.is_leaf:
+                batch.extend(f"{key},{value}" for key, value in zip(node.keys, node.values))
+            else:
+                if i > 0:
+                    batch.append(f"{node.keys[i - 1]},{node.values[i - 1]}")
+                if i < len(node.keys):
+                    stack.append((node, i + 1))
+                stack.append((self.get_node(node.children[i]), 0))
+            if len(batch) >= 1000:
+                write("\n".join(batch) + "\n")
+                batch = []
+        if batch:
+            write("\n".join(batch) + "\n")
+
     def print_all(self):
         if self.index_file is None:
             print("Error: No index file is open.")
             return
         if self.root:
             print("All key-value pairs in the B-tree:")
-            self.root.traverse()
+            self.traverse()
         else:
             print("The B-tree is empty.")
 
@@ -163,7 +432,7 @@ class IndexManager:
         try:
             with open(filename, 'w') as f:
                 if self.root:
-                    self.root.traverse(f)
+                    self.traverse(f)
                 else:
                     print("The B-tree is empty.")
             print(f"Data extracted to '{filename}'.")
@@ -172,146 +441,112 @@ class IndexManager:
             print("Error extracting data to file.")
 
 class BTreeNode:
+    __slots__ = ('index_manager', 'is_leaf', 'keys', 'values', 'children', 'offset', 'dirty')
+
     def __init__(self, index_manager, is_leaf=False, offset=None):
         self.index_manager = index_manager
         self.is_leaf = is_leaf
-        self.keys = []
-        self.values = []
-        self.children = []
+        self.keys = array('I')
+        self.values = array('I')
+        self.children = array('Q')
+        self.dirty = False
         self.offset = offset if offset is not None else self.allocate_offset()
         if offset is not None:
             self.load()
+        index_manager.cache_node(self)
 
     def allocate_offset(self):
         try:
-            with open(self.index_manager.index_file, 'ab') as f:
-                pos = f.tell()
-                f.write(b'\x00' * BLOCK_SIZE)
+            # Grow the file PREALLOC_BLOCKS at a time and hand out blocks from that reserve
+            manager = self.index_manager
+            pos = manager.file_end
+            if pos + BLOCK_SIZE > manager.reserved_end:
+                os.ftruncate(manager.fd, manager.reserved_end + PREALLOC_BLOCKS * BLOCK_SIZE)
+                manager.reserved_end += PREALLOC_BLOCKS * BLOCK_SIZE
+                manager.map_file()
+            manager.file_end = pos + BLOCK_SIZE
             return pos
         except IOError as e:
             logger.error(str(e))
             print("Error allocating space for node.")
             return 0
 
+    def pack(self, buf, pos=0):
+        packer = get_packer(len(self.keys), len(self.children))
+        packer.pack_into(buf, pos, self.is_leaf, len(self.keys), *self.keys, *self.values,
+                         *(child // BLOCK_SIZE for child in self.children))
+        buf[pos + packer.size:pos + BLOCK_SIZE] = _ZERO_BLOCK[packer.size:]
+
     def save(self):
-        try:
-            data = struct.pack('>?I', self.is_leaf, len(self.keys))
-            for key in self.keys:
-                data += struct.pack('>I', key)
-            for val in self.values:
-                data += struct.pack('>I', val)
-            for child in self.children:
-                data += struct.pack('>Q', child)
-            data += b'\x00' * (BLOCK_SIZE - len(data))
-            with open(self.index_manager.index_file, 'r+b') as f:
-                f.seek(self.offset)
-                f.write(data)
-        except IOError as e:
-            logger.error(str(e))
-            print("Error saving node.")
+        # Write-behind: the block is written by IndexManager.flush() or on cache eviction
+        self.dirty = True
+        self.index_manager.dirty_nodes[self.offset] = self
+        self.index_manager.cache_node(self)
 
     def load(self):
         try:
-            with open(self.index_manager.index_file, 'rb') as f:
-                f.seek(self.offset)
-                block_data = f.read(BLOCK_SIZE)
-            self.is_leaf, num_keys = struct.unpack('>?I', block_data[:5])
-            offset = 5
-            self.keys = [struct.unpack('>I', block_data[offset + i*4 : offset + (i+1)*4])[0] for i in range(num_keys)]
-            offset += num_keys * 4
-            self.values = [struct.unpack('>I', block_data[offset + i*4 : offset + (i+1)*4])[0] for i in range(num_keys)]
-            offset += num_keys * 4
-            if not self.is_leaf:
-                num_children = num_keys + 1
-                self.children = [struct.unpack('>Q', block_data[offset + i*8 : offset + (i+1)*8])[0] for i in range(num_children)]
+            mm = self.index_manager.mm
+            if self.offset + BLOCK_SIZE > len(mm):
+                raise IOError(f"Short read of node at offset {self.offset}.")
+            self.is_leaf, num_keys = NODE_HEADER.unpack_from(mm, self.offset)
+            pos = self.offset + NODE_HEADER.size
+            self.keys = read_array('I', mm, pos, num_keys)
+            pos += num_keys * 4
+            self.values = read_array('I', mm, pos, num_keys)
+            pos += num_keys * 4
+            num_children = 0 if self.is_leaf else num_keys + 1
+            blocks = read_array('I', mm, pos, num_children)
+            self.children = array('Q', [block * BLOCK_SIZE for block in blocks])
         except IOError as e:
             logger.error(str(e))
             print("Error loading node.")
 
     def insert_non_full(self, key, value):
-        try:
-            i = len(self.keys) - 1
-            if self.is_leaf:
-                self.keys.append(0)
-                self.values.append(0)
-                while i >= 0 and key < self.keys[i]:
-                    self.keys[i+1] = self.keys[i]
-                    self.values[i+1] = self.values[i]
-                    i -= 1
-                if i >= 0 and key == self.keys[i]:
+        # Walk down from this node, splitting full children before descending
+        node = self
+        while not node.is_leaf:
+            i = bisect.bisect_left(node.keys, key)
+            if i < len(node.keys) and node.keys[i] == key:
+                raise DuplicateKeyError(f"Error: Duplicate key {key}.")
+            child = self.index_manager.get_node(node.children[i])
+            if len(child.keys) == 2 * MIN_DEGREE - 1:
+                node.split_child(i, child)
+                if key == node.keys[i]:
                     raise DuplicateKeyError(f"Error: Duplicate key {key}.")
-                self.keys[i+1] = key
-                self.values[i+1] = value
-                self.save()
-            else:
-                while i >= 0 and key < self.keys[i]:
-                    i -= 1
-                i += 1
-                child = BTreeNode(self.index_manager, offset=self.children[i])
-                if len(child.keys) == 2 * MIN_DEGREE - 1:
-                    self.split_child(i, child)
-                    if key > self.keys[i]:
-                        i += 1
-                child = BTreeNode(self.index_manager, offset=self.children[i])
-                child.insert_non_full(key, value)
-        except DuplicateKeyError as e:
-            raise e
-        except Exception as e:
-            logger.error(str(e))
-            print("An error occurred during insertion.")
+                if key > node.keys[i]:
+                    child = self.index_manager.get_node(node.children[i + 1])
+            node = child
+        i = bisect.bisect_left(node.keys, key)
+        if i < len(node.keys) and node.keys[i] == key:
+            raise DuplicateKeyError(f"Error: Duplicate key {key}.")
+        node.keys.insert(i, key)
+        node.values.insert(i, value)
+        node.save()
 
     def split_child(self, index, child):
-        try:
-            new_child = BTreeNode(self.index_manager, is_leaf=child.is_leaf)
-            mid = MIN_DEGREE - 1
-            new_child.keys = child.keys[mid+1:]
-            new_child.values = child.values[mid+1:]
-            if not child.is_leaf:
-                new_child.children = child.children[mid+1:]
-            # Reduce the original child
-            child.keys = child.keys[:mid]
-            child.values = child.values[:mid]
-            if not child.is_leaf:
-                child.children = child.children[:mid+1]
-
-            self.keys.insert(index, child.keys[mid])
-            self.values.insert(index, child.values[mid])
-            self.children.insert(index+1, new_child.offset)
-
-            # Write changes to disk
-            child.save()
-            new_child.save()
-            self.save()
-        except Exception as e:
-            logger.error(str(e))
-            print("Error splitting child node.")
+        new_child = BTreeNode(self.index_manager, is_leaf=child.is_leaf)
+        mid = MIN_DEGREE - 1
+        # Take the median before child is truncated to its first mid entries
+        median_key = child.keys[mid]
+        median_value = child.values[mid]
+        new_child.keys = child.keys[mid+1:]
+        new_child.values = child.values[mid+1:]
+        if not child.is_leaf:
+            new_child.children = child.children[mid+1:]
+        # Reduce the original child
+        child.keys = child.keys[:mid]
+        child.values = child.values[:mid]
+        if not child.is_leaf:
+            child.children = child.children[:mid+1]
 
-    def search_key(self, key):
-        i = 0
-        while i < len(self.keys) and key > self.keys[i]:
-            i += 1
-        if i < len(self.keys) and key == self.keys[i]:
-            return self.values[i]
-        elif self.is_leaf:
-            return None
-        else:
-            child = BTreeNode(self.index_manager, offset=self.children[i])
-            return child.search_key(key)
+        self.keys.insert(index, median_key)
+        self.values.insert(index, median_value)
+        self.children.insert(index+1, new_child.offset)
 
-    def traverse(self, output_file=None):
-        # In-order traversal of the B-tree
-        for i in range(len(self.keys)):
-            if not self.is_leaf:
-                child = BTreeNode(self.index_manager, offset=self.children[i])
-                child.traverse(output_file)
-            entry = f"{self.keys[i]},{self.values[i]}"
-            if output_file:
-                output_file.write(entry + "\n")
-            else:
-                print(entry)
-        if not self.is_leaf:
-            child = BTreeNode(self.index_manager, offset=self.children[-1])
-            child.traverse(output_file)
+        # Write changes to disk; the next flush coalesces these adjacent blocks
+        child.save()
+        new_child.save()
+        self.save()
 
 def main():
     manager = IndexManager()
@@ -319,6 +554,7 @@ def main():
     while True:
         cmd = input("Command> ").strip().lower()
         if cmd in ('exit', 'quit'):
+            manager.close()
             print("Exiting.")
             break
         elif cmd.startswith('create '):
@@ -342,6 +578,7 @@ def main():
                 key = int(parts[1])
                 value = int(parts[2])
                 manager.insert(key, value)
+                manager.flush()
             except ValueError:
                 print("Error: Key and value must be integers.")
         elif cmd.startswith('search '):